@@ -23,11 +23,20 @@
 # *-------------------------------------  Libraries ------------------------------------------------------*
 # standard library modules
 import sys, errno, re, json, ssl
+import os, socket, sqlite3, shutil, threading
+import asyncio, gzip, hashlib, heapq, math, tempfile
+import atexit, base64, codecs, io
+from collections import deque
+from datetime import datetime, timezone
+from email.message import Message
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib import request
-from urllib.error import HTTPError
-from time import sleep
+from urllib.error import HTTPError, URLError
+from time import sleep, time, monotonic
 # Classifier function
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, NamedTuple, Iterator, AsyncIterator
 from pprint import pprint
 
 import argparse
@@ -95,156 +104,1610 @@ def interpro_accession_classifier(accession_file: str) -> Dict[str, List[str]]:
     return categories
 
 
-def interpro_api_sequence_downloader(db, accession, output_fasta, error_file):
+# *--------------------------------------* Library API *---------------------------------------------------*
+# The crawl is also usable from Python, without going through FASTA files:
+#
+#   from interpro_downloader import iter_proteins
+#   for protein in iter_proteins("pfam", "PF00001"):
+#       print(protein.accession, protein.name, len(protein.sequence))
+#
+# iter_pages() yields the raw API pages (with the total "count"), iter_proteins() and aiter_proteins() yield
+# ProteinRecord tuples. Pagination, retries and the optional on-disk page cache are handled inside.
 
-    # BASE_URL = f"https://www.ebi.ac.uk:443/interpro/api/protein/UniProt/entry/all/{db}/{accession}/?page_size=200&extra_fields=sequence"
-    BASE_URL = f"https://www.ebi.ac.uk:443/interpro/api/protein/UniProt/entry/{db}/{accession}/?page_size=200&extra_fields=sequence"
+API_URL = "https://www.ebi.ac.uk:443/interpro/api"
+PAGE_SIZE = 200
+HEADER_SEPARATOR = "|"
+LINE_LENGTH = 80
+# Seconds a request may wait for the API to connect or send data before it fails (and is retried)
+REQUEST_TIMEOUT = 120
 
-    HEADER_SEPARATOR = "|"
-    LINE_LENGTH = 80
 
-    context = ssl._create_unverified_context()
+class DownloadError(Exception):
+    # A page could not be downloaded, even after retrying
+    def __init__(self, url: str):
+        super().__init__(f"Failed to download {url}")
+        self.url = url
 
-    next = BASE_URL
-    last_page = False # flag
 
-    attempts = 0
-    protein_count = ""
+class EntryLocations(NamedTuple):
+    accession: str
+    # one list of (start, end) fragments per location of the entry on the protein
+    locations: List[List[Tuple[int, int]]]
 
-    # Counter of proteins
-    c = 0
 
-    # while next is not null (None) or empty
-    while next:
+class ProteinRecord(NamedTuple):
+    accession: str
+    name: str
+    # None when the API didn't return entry matches for the protein
+    entries: Optional[List[EntryLocations]]
+    sequence: str
+
+
+def _protein_path(db: str, accession: str, source: str = "UniProt", taxon: Optional[int] = None) -> str:
+    # source is UniProt (all proteins), reviewed or unreviewed; taxon optionally restricts to an NCBI taxon
+    # path = f"protein/UniProt/entry/all/{db}/{accession}/"
+    path = f"protein/{source}/entry/{db}/{accession}/"
+    if taxon is not None:
+        path += f"taxonomy/uniprot/{taxon}/"
+    return path
+
+
+def protein_url(db: str, accession: str, base_url: str = API_URL, page_size: int = PAGE_SIZE,
+                source: str = "UniProt", taxon: Optional[int] = None) -> str:
+    return f"{base_url}/{_protein_path(db, accession, source, taxon)}?page_size={page_size}&extra_fields=sequence"
+
+
+def _http_get(url: str, context: ssl.SSLContext) -> Tuple[int, bytes]:
+
+    if _traffic_replayer is not None:
+        return _traffic_replayer.get(url)
+
+    started = monotonic()
+    try:
+        req = request.Request(url, headers={"Accept": "application/json"})
+        res = request.urlopen(req, context=context, timeout=REQUEST_TIMEOUT) #===> If there is an HTTP error here, it raises HTTPError
+        status, headers, body = res.status, dict(res.headers.items()), res.read()
+    except HTTPError as error:
+        if _traffic_recorder is not None:
+            try:
+                body = error.read() or b""
+            except Exception:
+                body = b""
+            _traffic_recorder.record(url, error.code, dict((error.headers or {}).items()), started, body)
+        raise
+
+    if _traffic_recorder is not None:
+        _traffic_recorder.record(url, status, headers, started, body)
+    return status, body
+
+
+# *--------------------------------------* Traffic record and replay *---------------------------------------*
+# For reproducible performance tests, --record saves every API exchange (URL, status, headers, timing and body)
+# to a gzip-compressed JSON-lines archive, and --replay serves those exchanges back instead of the API, with the
+# recorded latencies divided by --replay-speed (0 = no waiting at all). The waits of the downloader itself
+# (retry back-off, pause between pages) are scaled the same way.
+
+TRAFFIC_FORMAT = "interpro-traffic"
+
+
+class ReplayMiss(DownloadError):
+    # The URL was never recorded: retrying can't help, so it fails at once
+    def __init__(self, url: str):
+        super().__init__(url)
+        self.args = (f"{url} is not in the replay archive",)
+
 
+class TrafficRecorder:
+
+    def __init__(self, archive: str):
+        # "x": an existing archive (an earlier recording) is never overwritten
+        self.fh = gzip.open(archive, mode="xt")
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.fh.write(json.dumps({"format": TRAFFIC_FORMAT, "version": 1, "api": API_URL,
+                                  "recorded": datetime.now(timezone.utc).isoformat()}) + "\n")
+        # The archive is only complete once the gzip stream is closed
+        atexit.register(self.close)
+
+    def record(self, url: str, status: int, headers: Dict[str, str], started: float, body: bytes):
+        exchange = {"url": url, "status": status, "headers": headers,
+                    "offset": round(started - self.start, 6), "elapsed": round(monotonic() - started, 6)}
         try:
-            req = request.Request(next, headers={"Accept": "application/json"})
-            res = request.urlopen(req, context=context) #===> If there is an HTTP error here, go to the except block
+            exchange["body"] = body.decode()
+        except UnicodeDecodeError:
+            exchange["body_b64"] = base64.b64encode(body).decode()
+        with self.lock:
+            self.fh.write(json.dumps(exchange) + "\n")
+
+    def close(self):
+        with self.lock:
+            if not self.fh.closed:
+                self.fh.close()
+
+
+class TrafficReplayer:
+
+    def __init__(self, archive: str, speed: float = 1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        # Exchanges of each URL in recorded order, e.g. two failures and then the successful retry
+        self.exchanges: Dict[str, deque] = {}
+        with gzip.open(archive, mode="rt") as archive_fh:
+            header = json.loads(archive_fh.readline())
+            if header.get("format") != TRAFFIC_FORMAT:
+                raise ValueError(f"{archive} is not a traffic archive recorded with --record")
+            for line in archive_fh:
+                exchange = json.loads(line)
+                self.exchanges.setdefault(exchange["url"], deque()).append(exchange)
+
+    def get(self, url: str) -> Tuple[int, bytes]:
+
+        with self.lock:
+            recorded = self.exchanges.get(url)
+            if not recorded:
+                exchange = None
+            elif len(recorded) > 1:
+                exchange = recorded.popleft()
+            else:
+                # The last exchange of a URL keeps being served, so longer runs still replay
+                exchange = recorded[0]
+
+        if exchange is None:
+            print(f"! {url} is not in the replay archive")
+            raise ReplayMiss(url)
+
+        pause(exchange["elapsed"])
+        if "body_b64" in exchange:
+            body = base64.b64decode(exchange["body_b64"])
+        else:
+            body = exchange["body"].encode()
+
+        if exchange["status"] >= 400:
+            headers = Message()
+            for name, value in exchange["headers"].items():
+                headers[name] = value
+            raise HTTPError(url, exchange["status"], "Replayed error", headers, io.BytesIO(body))
+        return exchange["status"], body
+
+
+_traffic_recorder: Optional[TrafficRecorder] = None
+_traffic_replayer: Optional[TrafficReplayer] = None
+
+
+def set_traffic_archive(record: Optional[str] = None, replay: Optional[str] = None, speed: float = 1.0):
+    global _traffic_recorder, _traffic_replayer
+    _traffic_recorder = TrafficRecorder(record) if record else None
+    _traffic_replayer = TrafficReplayer(replay, speed) if replay else None
+
+
+def _pause_seconds(seconds: float) -> float:
+    # While replaying, every wait is scaled by the replay speed
+    if _traffic_replayer is not None:
+        return seconds / _traffic_replayer.speed if _traffic_replayer.speed else 0
+    return seconds
+
+
+def pause(seconds: float):
+    sleep(_pause_seconds(seconds))
+
+
+class RateLimiter:
+    # Spaces the requests out to at most `rate` per second, across all the threads of the process
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        sleep(slot - now)
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def set_rate_limit(requests_per_second: Optional[float]):
+    # One budget for every crawl of the process (parallel workers, split sub-queries, service jobs)
+    global _rate_limiter
+    _rate_limiter = RateLimiter(requests_per_second) if requests_per_second else None
+
+
+def _cache_path(cache_dir: str, url: str) -> Path:
+    return Path(cache_dir) / (hashlib.sha1(url.encode()).hexdigest() + ".json.gz")
+
+
+def fetch_page(url: str, context: Optional[ssl.SSLContext] = None, retries: int = 3,
+               cache_dir: Optional[str] = None) -> Optional[dict]:
+    """Download one API page and return its JSON payload (None if the API has no data).
+
+    HTTP errors and network failures (unreachable host, timeout, reset connection) are retried; raises
+    DownloadError if the page still fails after `retries` attempts.
+    """
+
+    if cache_dir is not None:
+        cached = _cache_path(cache_dir, url)
+        if cached.exists():
+            with gzip.open(cached, mode="rt") as cache_fh:
+                return json.load(cache_fh)
+
+    if context is None:
+        context = ssl._create_unverified_context()
+
+    attempts = 0
+
+    while True:
+        if _rate_limiter is not None:
+            _rate_limiter.wait()
+        try:
+            status, body = _http_get(url, context)
 
             # If the API times out due a long running query
-            if res.status == 408:
+            if status == 408:
                 # wait just over a minute
-                sleep(61)
-                # then continue this loop with the same URL
-                continue #=> jumps back to the beginning of the loop (without updating the next (url) variable).
-            elif res.status == 204:
-                # no data so leave loop
-                #print(f"Response status 204: no data! Leaving the loop ...")
-                break
-
-            # JSON response (body or content) from the API => payload  
-            payload = json.loads(res.read().decode())
-            # Updating next variable with the new URL for pagination.
-            next = payload["next"]
-            # print(f"next url: {next}")
-            # Getting value of count key
-            protein_count = payload["count"]
-            #print(f"Number of proteins: {pt_count}")
-
-            # If, after some errors and attemps, it reached here then
-            # Reset attempts to 0
-            attempts = 0
-            # If this is the last page, i.e. next is null, update last_page flag
-            if not next:
-                last_page = True
-        
+                pause(61)
+                # then try again with the same URL
+                continue
+            elif status == 204:
+                # no data
+                payload = None
+            else:
+                # JSON response (body or content) from the API => payload
+                payload = json.loads(body.decode())
+            break
+
         except HTTPError as error:
 
             if error.code == 408:
-                sleep(61)
+                pause(61)
                 continue
-            else:
-                # If there is a different HTTP error, it wil re-try 3 times before failing
-                if attempts < 3:
-                    attempts += 1
-                    sleep(61)
-                    continue
-                else:
-                    with open(file = error_file, mode = "a") as error_fh:
-                        error_fh.write(f"Failed to download data for accession: {accession}")
-                        error_fh.write(f"Last URL: {next}\n")
+            failure = error
+        except (URLError, socket.timeout, ConnectionError) as error:
+            # The connection failed, timed out or was reset: retried like an HTTP error
+            failure = error
+
+        # If there is a different HTTP error, it wil re-try 3 times before failing
+        if attempts < retries:
+            attempts += 1
+            pause(61)
+            continue
+        raise DownloadError(url) from failure
+
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        # write then rename, so concurrent readers never see half a page
+        part = cached.with_name(f"{cached.name}.{os.getpid()}.{threading.get_ident()}.part")
+        with gzip.open(part, mode="wt") as cache_fh:
+            json.dump(payload, cache_fh)
+        os.replace(part, cached)
+
+    return payload
+
+
+def iter_pages(db: str, accession: str, base_url: str = API_URL, page_size: int = PAGE_SIZE,
+               retries: int = 3, cache_dir: Optional[str] = None, delay: float = 1,
+               source: str = "UniProt", taxon: Optional[int] = None) -> Iterator[dict]:
+    """Yield the API pages (JSON payloads with "count", "next" and "results") for an accession.
+
+    `source` and `taxon` restrict the crawl to reviewed/unreviewed proteins or to an NCBI taxon.
+    """
+
+    context = ssl._create_unverified_context()
+    # while next is not null (None) or empty
+    next = protein_url(db, accession, base_url, page_size, source, taxon)
+
+    while next:
+        from_cache = cache_dir is not None and _cache_path(cache_dir, next).exists()
+        payload = fetch_page(next, context, retries, cache_dir)
+        if payload is None:
+            return
+
+        yield payload
+
+        # Updating next variable with the new URL for pagination.
+        next = payload["next"]
+        # Don't overload the server, give it time before asking for more
+        if next and not from_cache:
+            pause(delay)
+
+
+def parse_protein(item: dict) -> ProteinRecord:
+
+    # item = result = dictionary
+    entries = None
+    if ("entry_subset" in item):
+        entries = item["entry_subset"]
+    elif ("entries" in item):
+        entries = item["entries"]
+
+    if entries is not None:
+        entries = [EntryLocations(entry["accession"],
+                                  [[(fragment["start"], fragment["end"]) for fragment in locations["fragments"]]
+                                   for locations in entry["entry_protein_locations"]])
+                   for entry in entries]
+
+    return ProteinRecord(accession=item["metadata"]["accession"],
+                         name=item["metadata"]["name"],
+                         entries=entries,
+                         sequence=item["extra_fields"]["sequence"])
+
+
+def iter_proteins(db: str, accession: str, **kwargs) -> Iterator[ProteinRecord]:
+    """Yield a ProteinRecord for every protein associated with an accession.
 
-                    #raise error
-                    return
+    Keyword arguments are passed to iter_pages().
+    """
+    for payload in iter_pages(db, accession, **kwargs):
+        for item in payload["results"]:
+            yield parse_protein(item)
 
-        # After the request is made and if there were no errors (or if all errors were handled)
-        # Open a file in write mode to store the sequences
+
+async def aiter_proteins(db: str, accession: str, base_url: str = API_URL, page_size: int = PAGE_SIZE,
+                         retries: int = 3, cache_dir: Optional[str] = None, delay: float = 1,
+                         source: str = "UniProt", taxon: Optional[int] = None) -> AsyncIterator[ProteinRecord]:
+    """Async counterpart of iter_proteins(); the blocking requests run in the default executor."""
+
+    loop = asyncio.get_running_loop()
+    context = ssl._create_unverified_context()
+    next = protein_url(db, accession, base_url, page_size, source, taxon)
+
+    while next:
+        from_cache = cache_dir is not None and _cache_path(cache_dir, next).exists()
+        payload = await loop.run_in_executor(None, fetch_page, next, context, retries, cache_dir)
+        if payload is None:
+            return
+
+        for item in payload["results"]:
+            yield parse_protein(item)
+
+        next = payload["next"]
+        if next and not from_cache:
+            await asyncio.sleep(_pause_seconds(delay))
+
+
+def fasta_header(record: ProteinRecord) -> str:
+
+    if record.entries is None:
+        return ">" + record.accession + HEADER_SEPARATOR + record.name
+
+    entries_header = "-".join(
+        [entry.accession + "(" + ";".join(
+            [
+                ",".join(
+                    [str(start) + "..." + str(end) for start, end in location]
+                    ) for location in entry.locations
+                    ]
+                    ) + ")" for entry in record.entries]
+                    )
+
+    return ">" + record.accession + HEADER_SEPARATOR + entries_header + HEADER_SEPARATOR + record.name
+
+
+def format_fasta(record: ProteinRecord) -> str:
+
+    seq = record.sequence
+    fastaSeqFragments = [seq[0+i:LINE_LENGTH+i] for i in range(0, len(seq), LINE_LENGTH)]
+
+    return fasta_header(record) + "\n" + "".join(fragment + "\n" for fragment in fastaSeqFragments)
+
+
+# *--------------------------------------* FASTA downloader *----------------------------------------------*
+
+def _download_pages(db, accession, output_fasta, cache_dir=None, source="UniProt", taxon=None,
+                    stop=None) -> Tuple[int, int, int]:
+    # Appends the proteins of one crawl to output_fasta, until the crawl ends or the stop event is set.
+    # Returns the count reported by the API, the proteins with entries (c) and all the proteins written.
+
+    protein_count = ""
+
+    # Counter of proteins
+    c = 0
+    written = 0
+
+    for payload in iter_pages(db, accession, cache_dir=cache_dir, source=source, taxon=taxon):
+        # Getting value of count key
+        protein_count = payload["count"]
+
+        # Open the file in append mode to store the sequences of this page
         with open(file = output_fasta, mode='a') as fasta_file:
-            
-            for i, item in enumerate(payload["results"]):
-
-                # item = result = dictionary
-                entries = None
-                if ("entry_subset" in item):
-                    entries = item["entry_subset"]
-                elif ("entries" in item):
-                    entries = item["entries"]
-
-                if entries is not None:
-                    entries_header = "-".join(
-                        [entry["accession"] + "(" + ";".join(
-                            [
-                                ",".join(
-                                    [ str(fragment["start"]) + "..." + str(fragment["end"]) 
-                                    for fragment in locations["fragments"]]
-                                    ) for locations in entry["entry_protein_locations"]
-                                    ]
-                                    ) + ")" for entry in entries]
-                                    )
 
+            for item in payload["results"]:
+                protein = parse_protein(item)
+
+                if protein.entries is not None:
                     # Increasing the counter of proteins
                     c += 1
                     print(f"# Result {c}: Protein {c}/{protein_count} for accession {accession}")
+                    print(f"Protein ID: {fasta_header(protein)[1:]}")
 
-                    id = ('>' + item["metadata"]["accession"] + HEADER_SEPARATOR + 
-                            entries_header + HEADER_SEPARATOR + 
-                            item['metadata']['name'])
-                    print(f"Protein ID: {id[1:]}")
+                fasta_file.write(format_fasta(protein))
+                written += 1
 
-                    fasta_file.write(">" + item["metadata"]["accession"] + HEADER_SEPARATOR
-                                        + entries_header + HEADER_SEPARATOR
-                                        + item["metadata"]["name"] + "\n")
+        # checked before the next page is requested
+        if stop is not None and stop.is_set():
+            break
 
-                else:
-                    fasta_file.write(">" + item["metadata"]["accession"] + HEADER_SEPARATOR 
-                                        + item["metadata"]["name"] + "\n")
+    return protein_count, c, written
 
-                seq = item["extra_fields"]["sequence"]
 
-                fastaSeqFragments = [seq[0+i:LINE_LENGTH+i] for i in range(0, len(seq), LINE_LENGTH)]
-                
-                for fastaSeqFragment in fastaSeqFragments:
-                    fasta_file.write(fastaSeqFragment + "\n")
+def interpro_api_sequence_downloader(db, accession, output_fasta, error_file, cache_dir=None,
+                                     split_threshold=None, split_workers=4):
+
+    try:
+        parts = _split_parts(db, accession, split_threshold, cache_dir) if split_threshold is not None else None
+        if parts is not None:
+            protein_count, c, written = _download_split(db, accession, output_fasta, cache_dir, parts, split_workers)
+            if written != protein_count:
+                with open(file = error_file, mode = "a") as error_fh:
+                    error_fh.write(f"Split download of accession {accession} has {written} proteins, "
+                                   f"the API reports {protein_count}\n")
+        else:
+            protein_count, c, written = _download_pages(db, accession, output_fasta, cache_dir)
+
+    except DownloadError as error:
+        with open(file = error_file, mode = "a") as error_fh:
+            error_fh.write(f"Failed to download data for accession: {accession}")
+            error_fh.write(f"Last URL: {error.url}\n")
+            if isinstance(error, ReplayMiss):
+                error_fh.write(f"{error}\n")
+
+        #raise error
+        return None
 
-            # Don't overload the server, give it time before asking for more
-            if next:
-                sleep(1)
-    
     print(f"*~~ Finished downloading proteins associated with accession {accession}. ~~*")
     print(f"*~~ The accession {accession} had {protein_count} associated proteins that should have been downloaded.~~*")
     print(f"*~~ The number of proteins downloaded was {c}.~~*")
 
+    return c
+
+# *--------------------------------------* Splitting giant accessions *------------------------------------*
+# The API pagination is a chain of opaque "next" cursors, so one accession is crawled one page at a time.
+# Accessions above a size threshold are split into sub-queries that cover the same proteins without overlap:
+# reviewed + unreviewed, and if one of them is still too big, by the top-level nodes of the NCBI taxonomy.
+# The sub-queries are crawled concurrently and concatenated, and the total is checked against the parent count.
+
+SPLIT_SOURCES = ("reviewed", "unreviewed")
+# Children of the taxonomy root: Bacteria, Archaea and Eukaryota (all the cellular organisms), Viruses,
+# "other entries" and "unclassified entries"
+SPLIT_TAXA = (2, 2157, 2759, 10239, 2787854, 2787823)
+
+
+class SubQuery(NamedTuple):
+    source: str = "UniProt"
+    taxon: Optional[int] = None
+
+
+def split_subqueries(db: str, accession: str, threshold: int, base_url: str = API_URL,
+                     cache_dir: Optional[str] = None) -> List[Tuple[SubQuery, int]]:
+
+    parts = []
+    for source in SPLIT_SOURCES:
+        count = probe_count(db, accession, base_url, cache_dir, source=source)
+        if count > threshold:
+            for taxon in SPLIT_TAXA:
+                taxon_count = probe_count(db, accession, base_url, cache_dir, source=source, taxon=taxon)
+                if taxon_count:
+                    parts.append((SubQuery(source, taxon), taxon_count))
+        elif count:
+            parts.append((SubQuery(source), count))
+
+    return parts
+
+
+def _split_parts(db, accession, threshold, cache_dir) -> Optional[List[Tuple[SubQuery, int]]]:
+    # The sub-queries of an accession above the threshold, or None to crawl it in one piece.
+    # A count that can't be probed doesn't fail the accession: it is crawled unsplit, like without a threshold.
+    try:
+        if probe_count(db, accession, cache_dir=cache_dir) <= threshold:
+            return None
+        return split_subqueries(db, accession, threshold, cache_dir=cache_dir)
+    except DownloadError as error:
+        print(f"! Could not probe {error.url}: downloading accession {accession} without splitting it")
+        return None
+
+
+def _download_split(db, accession, output_fasta, cache_dir, parts, workers) -> Tuple[int, int, int]:
+
+    parent_count = probe_count(db, accession, cache_dir=cache_dir)
+    print(f"*~~ Accession {accession} has {parent_count} proteins, split into {len(parts)} sub-queries: " +
+          ", ".join(f"{part.source}" + (f"/taxon {part.taxon}" if part.taxon else "") + f" ({count})"
+                    for part, count in parts) + " ~~*")
+
+    part_dir = tempfile.mkdtemp(prefix=".interpro_split_", dir=Path(output_fasta).resolve().parent)
+    try:
+        part_files = [str(Path(part_dir) / f"{n:03d}.fasta") for n in range(len(parts))]
+
+        # Set by the first sub-query that fails: the ones not started are skipped and the running ones stop
+        # after their current page, instead of downloading everything that is thrown away
+        stop = threading.Event()
+
+        def crawl(part, part_file):
+            if stop.is_set():
+                return None
+            try:
+                return _download_pages(db, accession, part_file, cache_dir, part.source, part.taxon, stop)
+            except BaseException:
+                stop.set()
+                raise
+
+        pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        try:
+            futures = [pool.submit(crawl, part, part_file) for (part, _), part_file in zip(parts, part_files)]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            # .result() re-raises the first DownloadError, then nothing of this accession is written
+            for future in done:
+                future.result()
+            results = [future.result() for future in futures]
+        finally:
+            stop.set()
+            pool.shutdown(cancel_futures=True)
+
+        # Only append to the output once every sub-query succeeded
+        with open(output_fasta, mode="ab") as fasta_fh:
+            for part_file in part_files:
+                if Path(part_file).exists():
+                    with open(part_file, mode="rb") as part_fh:
+                        shutil.copyfileobj(part_fh, fasta_fh)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    return parent_count, sum(c for _, c, _ in results), sum(written for _, _, written in results)
+
+# *--------------------------------------* Distributed work queue *----------------------------------------*
+# The coordinator writes the classified accession list into a SQLite file on shared storage.
+# Workers (on one or several nodes) claim accessions with a time-limited lease, keep the lease alive with
+# a heartbeat while downloading, and write one FASTA shard per accession. If a worker dies its lease
+# expires and another worker reclaims the accession. The merge step concatenates the shards in the
+# original classifier order, so the final FASTA is the same one main() creates in a single process.
+
+# A worker that dies on an accession loses its lease; after this many claims the accession is marked failed
+MAX_ATTEMPTS = 3
+
+
+class QueueError(Exception):
+    # The queue can't be filled or merged (already used, unfinished accessions)
+    pass
+
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    position INTEGER PRIMARY KEY,
+    db TEXT NOT NULL,
+    accession TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+def queue_connect(queue_file: str) -> sqlite3.Connection:
+    # isolation_level=None => autocommit, the claim opens its own IMMEDIATE transaction
+    conn = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    conn.execute(QUEUE_SCHEMA)
+    return conn
+
+
+def queue_populate(queue_file: str, accessions_dict: Dict[str, List[str]],
+                   counts: Optional[Dict[Tuple[str, str], int]] = None) -> int:
+
+    conn = queue_connect(queue_file)
+    try:
+        if conn.execute("SELECT COUNT(*) FROM work").fetchone()[0]:
+            raise QueueError(f"The queue {queue_file} already has work in it. Please use a new queue file.")
+
+        # Same order as the loop in main(): by database, then by position in the accession file.
+        # With planned counts, workers claim the largest accessions first (priority = protein count).
+        counts = counts or {}
+        rows = [(db_key, accession, counts.get((db_key, accession), 0))
+                for db_key, accession_list in accessions_dict.items()
+                for accession in accession_list]
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO work (db, accession, priority) VALUES (?, ?, ?)", rows)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    return len(rows)
+
+
+def queue_claim(conn: sqlite3.Connection, worker_id: str, lease_seconds: float,
+                max_attempts: int = MAX_ATTEMPTS) -> Optional[Tuple[int, str, str]]:
+
+    now = time()
+    # IMMEDIATE takes the write lock up front, so two workers can't claim the same row
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("""SELECT position, db, accession FROM work
+                              WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ? AND attempts < ?)
+                              ORDER BY priority DESC, position LIMIT 1""", (now, max_attempts)).fetchone()
+        if row is not None:
+            conn.execute("""UPDATE work SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                            WHERE position = ?""", (worker_id, now + lease_seconds, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return row
+
+
+def queue_fail_exhausted(conn: sqlite3.Connection, max_attempts: int = MAX_ATTEMPTS) -> List[Tuple[int, str, int]]:
+    # Expired leases of accessions already claimed max_attempts times are marked failed instead of reclaimed.
+    # Returns (position, accession, attempts) of the rows this call marked, so only one worker reports each.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("""SELECT position, accession, attempts FROM work
+                               WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                            (time(), max_attempts)).fetchall()
+        conn.executemany("UPDATE work SET state = 'failed', lease_expires = NULL WHERE position = ?",
+                         [(row[0],) for row in rows])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return rows
+
+
+def queue_renew(conn: sqlite3.Connection, worker_id: str, position: int, lease_seconds: float) -> bool:
+    # Returns False if the lease was lost (expired and reclaimed by another worker)
+    cursor = conn.execute("""UPDATE work SET lease_expires = ?
+                             WHERE position = ? AND worker = ? AND state = 'leased'""",
+                          (time() + lease_seconds, position, worker_id))
+    return cursor.rowcount == 1
+
+
+def queue_complete(conn: sqlite3.Connection, worker_id: str, position: int) -> bool:
+    cursor = conn.execute("""UPDATE work SET state = 'done', lease_expires = NULL
+                             WHERE position = ? AND worker = ? AND state = 'leased'""",
+                          (position, worker_id))
+    return cursor.rowcount == 1
+
+
+def queue_status(conn: sqlite3.Connection) -> Dict[str, int]:
+    return dict(conn.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+
+
+def shard_paths(shard_dir: str, position: int) -> Tuple[Path, Path]:
+    # One FASTA shard and one error shard per accession, named after its position in the queue
+    return (Path(shard_dir) / f"{position:08d}.fasta",
+            Path(shard_dir) / f"{position:08d}.errors.txt")
+
+
+def download_to_shard(db, accession, shard_dir, position, worker_id, **options):
+
+    fasta_shard, error_shard = shard_paths(shard_dir, position)
+    # Download into worker-private .part files first, so a dead worker never leaves a half shard behind
+    # and a reclaimed accession starts from scratch.
+    fasta_part = fasta_shard.with_name(f"{fasta_shard.name}.{worker_id}.part")
+    error_part = error_shard.with_name(f"{error_shard.name}.{worker_id}.part")
+    for part in (fasta_part, error_part):
+        if part.exists():
+            part.unlink()
+    fasta_part.touch()
+    error_part.touch()
+
+    try:
+        interpro_api_sequence_downloader(db=db,
+                                         accession=accession,
+                                         output_fasta=str(fasta_part),
+                                         error_file=str(error_part),
+                                         **options
+                                         )
+    except BaseException:
+        for part in (fasta_part, error_part):
+            part.unlink()
+        raise
+
+    # Atomic rename: if two workers finish the same accession they write the same shard
+    os.replace(error_part, error_shard)
+    os.replace(fasta_part, fasta_shard)
+
+
+def fail_shard(shard_dir, position, accession, reason):
+    # An empty FASTA shard and an error shard for an accession that couldn't be downloaded, so the merge step
+    # can still finish. A shard already written (by a worker that finished after all) is kept.
+    fasta_shard, error_shard = shard_paths(shard_dir, position)
+    if not fasta_shard.exists():
+        fasta_shard.touch()
+        error_shard.write_text(f"Failed to download data for accession: {accession} ({reason})\n")
+
+
+def _heartbeat(queue_file, worker_id, position, lease_seconds, stop):
+    # sqlite connections can't be shared between threads, the heartbeat uses its own
+    conn = queue_connect(queue_file)
+    try:
+        while not stop.wait(lease_seconds / 3):
+            if not queue_renew(conn, worker_id, position, lease_seconds):
+                print(f"! Worker {worker_id} lost the lease on queue position {position}")
+                return
+    finally:
+        conn.close()
+
+
+def queue_worker(queue_file: str, shard_dir: str, worker_id: str, lease_seconds: float = 300, poll_seconds: float = 30,
+                 max_attempts: int = MAX_ATTEMPTS, **options):
+    # options are passed on to interpro_api_sequence_downloader (cache_dir, split_threshold, ...)
+
+    Path(shard_dir).mkdir(parents=True, exist_ok=True)
+    conn = queue_connect(queue_file)
+
+    try:
+        while True:
+            for position, accession, attempts in queue_fail_exhausted(conn, max_attempts):
+                fail_shard(shard_dir, position, accession, f"the worker was lost {attempts} times")
+                print(f"! Queue position {position} ({accession}) failed after {attempts} attempts")
+
+            claim = queue_claim(conn, worker_id, lease_seconds, max_attempts)
+
+            if claim is None:
+                status = queue_status(conn)
+                if not status.get("pending") and not status.get("leased"):
+                    break
+                # Other workers still hold leases: wait, they may finish or expire and be reclaimed
+                sleep(poll_seconds)
+                continue
+
+            position, db, accession = claim
+            print(f"\n$ Worker {worker_id} claimed queue position {position}: {accession} from the {db.upper()} database")
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat,
+                                         args=(queue_file, worker_id, position, lease_seconds, stop),
+                                         daemon=True)
+            heartbeat.start()
+            try:
+                download_to_shard(db, accession, shard_dir, position, worker_id, **options)
+            except Exception as error:
+                # Pages failing after the retries are logged by the download itself; anything else is logged
+                # here and the accession completed, instead of killing the worker with the lease still held
+                print(f"! Worker {worker_id} failed on queue position {position} ({accession}): {error!r}")
+                fail_shard(shard_dir, position, accession, repr(error))
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            if not queue_complete(conn, worker_id, position):
+                print(f"! Worker {worker_id} finished position {position} after its lease was reclaimed")
+            print("\n")
+    finally:
+        conn.close()
+
+    print(f"*~~* Worker {worker_id}: no work left in the queue *~~*")
+
+
+def queue_merge(queue_file: str, shard_dir: str, output_fasta: str, error_file: str):
+
+    conn = queue_connect(queue_file)
+    try:
+        status = queue_status(conn)
+        rows = conn.execute("SELECT position, accession FROM work ORDER BY position").fetchall()
+    finally:
+        conn.close()
+
+    unfinished = sum(count for state, count in status.items() if state not in ("done", "failed"))
+    if unfinished:
+        raise QueueError(f"The queue still has {unfinished} unfinished accessions: {status}. Merge aborted.")
+
+    merge_shards(rows, shard_dir, output_fasta, error_file)
+    print(f"*~~* Merged {len(rows)} shards into {output_fasta} *~~*")
+
+
+def merge_shards(rows: List[Tuple[int, str]], shard_dir: str, output_fasta: str, error_file: str):
+    # rows = (position, accession) in output order
+
+    def log_error(data: bytes):
+        # Like the single-process run, the error file is only created if something failed
+        with open(error_file, mode="ab") as error_fh:
+            error_fh.write(data)
+
+    with open(output_fasta, mode="wb") as fasta_fh:
+        for position, accession in rows:
+            fasta_shard, error_shard = shard_paths(shard_dir, position)
+            if not fasta_shard.exists():
+                # Finished in the queue but the shard is missing (e.g. shard dir not shared)
+                log_error(f"Missing shard {fasta_shard} for accession: {accession}\n".encode())
+                continue
+            with open(fasta_shard, mode="rb") as shard_fh:
+                shutil.copyfileobj(shard_fh, fasta_fh)
+            if error_shard.exists() and error_shard.stat().st_size:
+                log_error(error_shard.read_bytes())
+
+# *--------------------------------------* Download planner *----------------------------------------------*
+# Before downloading, every accession's protein count is probed with a one-protein page. The counts give an
+# estimate of the transfer size and duration, and let the parallel runs start the largest accessions first
+# (longest-processing-time first), so a huge family started last doesn't decide the total wall time.
+
+# Rough averages used for the estimates: one protein with its sequence and entry locations in the API JSON,
+# and one page of PAGE_SIZE proteins including the pause between pages.
+EST_BYTES_PER_PROTEIN = 1500
+EST_SECONDS_PER_PAGE = 2.0
+
+
+class PlanItem(NamedTuple):
+    # position in the classifier order, which is also the order of the final FASTA
+    position: int
+    db: str
+    accession: str
+    count: int
+
+
+_count_cache: Dict[str, int] = {}
+_count_lock = threading.Lock()
+
+
+def count_url(db: str, accession: str, base_url: str = API_URL,
+              source: str = "UniProt", taxon: Optional[int] = None) -> str:
+    return f"{base_url}/{_protein_path(db, accession, source, taxon)}?page_size=1"
+
+
+def probe_count(db: str, accession: str, base_url: str = API_URL, cache_dir: Optional[str] = None,
+                source: str = "UniProt", taxon: Optional[int] = None) -> int:
+    # Counts are kept for the whole run, and in the page cache across runs when cache_dir is given
+    url = count_url(db, accession, base_url, source, taxon)
+    with _count_lock:
+        if url in _count_cache:
+            return _count_cache[url]
+
+    payload = fetch_page(url, cache_dir=cache_dir)
+    count = payload["count"] if payload is not None else 0
+
+    with _count_lock:
+        _count_cache[url] = count
+    return count
+
+
+def _pages(count: int) -> int:
+    return max(1, math.ceil(count / PAGE_SIZE))
+
+
+def plan_downloads(accessions_dict: Dict[str, List[str]], workers: int = 1, base_url: str = API_URL,
+                   cache_dir: Optional[str] = None) -> List[PlanItem]:
+    """Probe every accession's count (`workers` probes at a time) and order the accessions largest first.
+
+    Returns the PlanItems in the order they are handed out: each worker takes the next one as soon as it is free.
+    """
+
+    accessions = [(db_key, accession) for db_key, accession_list in accessions_dict.items()
+                                      for accession in accession_list]
+
+    def probe(position_db_accession):
+        position, (db, accession) = position_db_accession
+        try:
+            count = probe_count(db, accession, base_url, cache_dir)
+        except DownloadError:
+            # Unknown size: schedule it last, the download itself will log the failure
+            print(f"! Could not probe the number of proteins for accession {accession}")
+            count = 0
+        return PlanItem(position, db, accession, count)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        items = list(pool.map(probe, enumerate(accessions, start=1)))
+
+    # Longest-processing-time first
+    return sorted(items, key=lambda item: (-item.count, item.position))
+
+
+def estimated_duration(items: List[PlanItem], workers: int = 1) -> float:
+    # The next accession goes to the first free worker: simulate it with the estimated page times,
+    # the slowest worker decides the wall time
+    loads = [0.0] * max(1, workers)
+    for item in items:
+        heapq.heapreplace(loads, loads[0] + _pages(item.count) * EST_SECONDS_PER_PAGE)
+    return max(loads)
+
+
+def _human_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def _human_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
+
+
+def print_plan(items: List[PlanItem], workers: int = 1):
+
+    proteins = sum(item.count for item in items)
+
+    print(f"*~~* Download plan: {len(items)} accessions, {proteins} proteins *~~*")
+    print(f"*~~* Estimated transfer: {_human_bytes(proteins * EST_BYTES_PER_PROTEIN)}, "
+          f"estimated duration: {_human_duration(estimated_duration(items, workers))} with {workers} worker(s) *~~*")
+
+    print(f"\n$ Download order: each of the {workers} worker(s) takes the next accession as soon as it is free")
+    for n, item in enumerate(items, start=1):
+        print(f"    {n}. {item.accession} ({item.db}): {item.count} proteins, {_pages(item.count)} pages")
+    print("\n")
+
+
+def unplanned_schedule(accessions_dict: Dict[str, List[str]]) -> List[PlanItem]:
+    # Classifier order, for shard-based runs without --plan
+    return [PlanItem(position, db_key, accession, 0)
+            for position, (db_key, accession) in enumerate(((db_key, accession)
+                                                            for db_key, accession_list in accessions_dict.items()
+                                                            for accession in accession_list), start=1)]
+
+
+def run_parallel(items: List[PlanItem], output_fasta: str, error_file: str, workers: int = 1,
+                 hierarchy: Optional[List["MemberGroup"]] = None, **options):
+    # items from plan_downloads or unplanned_schedule, downloaded by `workers` threads
+    # options are passed on to interpro_api_sequence_downloader (cache_dir, split_threshold, ...)
+    # hierarchy (from plan_hierarchy) lists the signatures derived from one shared download
+
+    # Each accession goes to its own shard next to the output, the shards are merged in classifier order
+    shard_dir = tempfile.mkdtemp(prefix=".interpro_shards_", dir=Path(output_fasta).resolve().parent)
+
+    by_key = {(item.db, item.accession): item for item in items}
+    groups = [(group, [by_key[(group.db, signature)] for signature in group.signatures])
+              for group in hierarchy or []
+              if all((group.db, signature) in by_key for signature in group.signatures)]
+    derived = {(member.db, member.accession) for _, members in groups for member in members}
+
+    def log_failure(failed_items, error):
+        # an unexpected error (pages failing after the retries are logged by the download itself): log it in
+        # the shards of these accessions and let the other downloads and the merge carry on
+        for failed in failed_items:
+            fail_shard(shard_dir, failed.position, failed.accession, repr(error))
+
+    def download(item):
+        print(f"\n$ Accession {item.position}: {item.accession} from the {item.db.upper()} database")
+        try:
+            download_to_shard(item.db, item.accession, shard_dir, item.position, "local", **options)
+        except Exception as error:
+            log_failure([item], error)
+
+    def download_group(group, members):
+        print(f"\n$ Accessions {', '.join(group.signatures)} from the {group.db.upper()} database, "
+              f"integrated in {group.entry}")
+        try:
+            download_group_to_shards(group, members, shard_dir, "local", **options)
+        except Exception as error:
+            log_failure(members, error)
+
+    # (size, position, work): single accessions, and shared downloads as large as their signatures together
+    work = [(item.count, item.position, partial(download, item))
+            for item in items if (item.db, item.accession) not in derived]
+    work += [(sum(member.count for member in members), members[0].position, partial(download_group, group, members))
+             for group, members in groups]
+
+    try:
+        # The pool hands the next accession to whichever thread is free first, so submitting in
+        # largest-first order is the LPT schedule with the real durations.
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(task) for _, _, task in sorted(work, key=lambda unit: (-unit[0], unit[1]))]
+            for future in futures:
+                future.result()
+
+        merge_shards(sorted((item.position, item.accession) for item in items), shard_dir, output_fasta, error_file)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+# *--------------------------------------* Entry hierarchy *-----------------------------------------------*
+# An InterPro entry (IPR...) integrates member database signatures (PF..., PTHR..., SM..., cd...). When a list has
+# an InterPro entry and several of its signatures from the same member database, those signatures are crawled
+# together, once, with the filter entry/<member db>/integrated/<IPR>/. It returns the proteins matched by any of
+# the database's signatures integrated in the entry, and each record's entries are the signatures that matched,
+# so every signature's subset is written from the same records. Each derived subset is checked against the
+# signature's own count and the signature is crawled directly if they don't agree.
+
+class MemberGroup(NamedTuple):
+    # member database (classifier key), InterPro entry, signatures of the list crawled together
+    db: str
+    entry: str
+    signatures: List[str]
+
+
+def integrated_filter(entry: str) -> str:
+    # Takes the place of the accession in a member database filter: entry/pfam/integrated/IPR000001/
+    return f"integrated/{entry}"
+
+
+def entry_members(accession: str, base_url: str = API_URL, cache_dir: Optional[str] = None) -> Dict[str, List[str]]:
+    # member_databases = {"pfam": {"PF00051": "Kringle"}, "smart": {"SM00130": "KR"}, ...}
+    payload = fetch_page(f"{base_url}/entry/interpro/{accession}/", cache_dir=cache_dir)
+    if payload is None:
+        return {}
+    members = payload["metadata"].get("member_databases") or {}
+    return {member_db.lower(): list(signatures) for member_db, signatures in members.items()}
+
+
+def plan_hierarchy(accessions_dict: Dict[str, List[str]], base_url: str = API_URL,
+                   cache_dir: Optional[str] = None) -> List[MemberGroup]:
+    """Group the signatures of the list integrated in the same InterPro entry of the list, by member database."""
+
+    groups = []
+    covered = set()
+
+    for entry in accessions_dict.get("InterPro", []):
+        try:
+            members = entry_members(entry, base_url, cache_dir)
+        except DownloadError:
+            print(f"! Could not get the member signatures of {entry}, its members will be downloaded separately")
+            continue
+
+        for db_key, accession_list in accessions_dict.items():
+            member_signatures = {signature.lower() for signature in members.get(db_key.lower(), [])}
+            signatures = [accession for accession in accession_list
+                          if accession.lower() in member_signatures and (db_key, accession) not in covered]
+            # A single signature gains nothing from a shared crawl
+            if len(signatures) == 1:
+                print(f"*~~* {signatures[0]} is integrated in {entry} but is the only {db_key} signature of the list "
+                      f"in it: it is downloaded on its own *~~*")
+            if len(signatures) < 2:
+                continue
+            groups.append(MemberGroup(db_key, entry, signatures))
+            covered.update((db_key, accession) for accession in signatures)
+            print(f"*~~* {', '.join(signatures)} are integrated in {entry}: "
+                  f"they are derived from a single {db_key} download *~~*")
+
+    return groups
+
+
+def download_group_to_shards(group: MemberGroup, members: List[PlanItem], shard_dir, worker_id, **options):
+
+    cache_dir = options.get("cache_dir")
+    # Member subsets are collected in their own .part files while the group is crawled
+    parts = {}
+    counts = {}
+    for member in members:
+        fasta_shard, _ = shard_paths(shard_dir, member.position)
+        parts[member.accession.lower()] = open(fasta_shard.with_name(f"{fasta_shard.name}.{worker_id}.part"), mode="w")
+        counts[member.accession.lower()] = 0
+
+    crawled = True
+    try:
+        for payload in iter_pages(group.db, integrated_filter(group.entry), cache_dir=cache_dir):
+            for item in payload["results"]:
+                protein = parse_protein(item)
+                for signature in {matched.accession.lower() for matched in protein.entries or []} & parts.keys():
+                    subset = [matched for matched in protein.entries if matched.accession.lower() == signature]
+                    parts[signature].write(format_fasta(protein._replace(entries=subset)))
+                    counts[signature] += 1
+    except DownloadError as error:
+        print(f"! The shared download of {', '.join(group.signatures)} failed at {error.url}")
+        crawled = False
+    finally:
+        for part in parts.values():
+            part.close()
+
+    for member in members:
+        fasta_shard, error_shard = shard_paths(shard_dir, member.position)
+        part = Path(parts[member.accession.lower()].name)
+        derived = counts[member.accession.lower()]
+        try:
+            expected = probe_count(member.db, member.accession, cache_dir=cache_dir)
+        except DownloadError:
+            expected = None
+
+        if crawled and derived == expected:
+            print(f"*~~ {derived} proteins of {member.accession} derived from the {group.db} proteins of {group.entry} ~~*")
+            error_shard.touch()
+            os.replace(part, fasta_shard)
+        else:
+            # The shared crawl failed, or its records didn't carry this signature's matches: crawl it directly
+            print(f"*~~ {derived} proteins of {member.accession} found in the shared download, "
+                  f"the API reports {expected}: downloading {member.accession} directly ~~*")
+            part.unlink()
+            download_to_shard(member.db, member.accession, shard_dir, member.position, worker_id, **options)
+
+# *--------------------------------------* Download service *----------------------------------------------*
+# A long-running local daemon for several users downloading overlapping accession lists at the same time.
+# Clients POST a job (the classified accession list) and get the FASTA back as a stream of JSON lines.
+# Identical accessions requested by several jobs while they are being downloaded are crawled only once, and
+# all the jobs share the same connections' rate budget (--rate-limit) and page cache (--cache-dir).
+
+class ServiceError(Exception):
+    # The download service can't be reached
+    pass
+
+
+class Crawl:
+    # One accession being downloaded into a spool file, read by every job that asked for it
+    def __init__(self, db: str, accession: str, spool_dir: str):
+        self.db = db
+        self.accession = accession
+        name = hashlib.sha1(f"{db}/{accession}".encode()).hexdigest()
+        self.fasta = Path(spool_dir) / f"{name}.fasta"
+        self.errors = Path(spool_dir) / f"{name}.errors.txt"
+        self.fasta.touch()
+        self.done = threading.Event()
+        self.readers = 0
+
+
+class CrawlRegistry:
+
+    def __init__(self, spool_dir: str, workers: int = 4, **options):
+        # options are passed on to interpro_api_sequence_downloader (cache_dir, split_threshold, ...)
+        self.spool_dir = spool_dir
+        self.options = options
+        self.crawls: Dict[Tuple[str, str], Crawl] = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def acquire(self, db: str, accession: str) -> Crawl:
+        with self.lock:
+            crawl = self.crawls.get((db, accession))
+            if crawl is None:
+                crawl = self.crawls[(db, accession)] = Crawl(db, accession, self.spool_dir)
+                self.pool.submit(self._run, crawl)
+            else:
+                print(f"*~~ Joining the in-flight download of accession {accession} ~~*")
+            crawl.readers += 1
+        return crawl
+
+    def release(self, crawl: Crawl):
+        with self.lock:
+            crawl.readers -= 1
+            self._drop_if_unused(crawl)
+
+    def _run(self, crawl: Crawl):
+        try:
+            interpro_api_sequence_downloader(db=crawl.db,
+                                             accession=crawl.accession,
+                                             output_fasta=str(crawl.fasta),
+                                             error_file=str(crawl.errors),
+                                             **self.options
+                                             )
+        except Exception as error:
+            with open(crawl.errors, mode="a") as error_fh:
+                error_fh.write(f"Failed to download data for accession: {crawl.accession} ({error})\n")
+        finally:
+            with self.lock:
+                crawl.done.set()
+                self._drop_if_unused(crawl)
+
+    def _drop_if_unused(self, crawl: Crawl):
+        # Finished and nobody reading: later jobs for this accession are served from the page cache (if any)
+        if crawl.done.is_set() and crawl.readers == 0:
+            if self.crawls.get((crawl.db, crawl.accession)) is crawl:
+                del self.crawls[(crawl.db, crawl.accession)]
+                for path in (crawl.fasta, crawl.errors):
+                    if path.exists():
+                        path.unlink()
+
+    def status(self) -> List[dict]:
+        with self.lock:
+            return [{"db": crawl.db, "accession": crawl.accession, "readers": crawl.readers,
+                     "done": crawl.done.is_set()} for crawl in self.crawls.values()]
+
+
+def _follow(crawl: Crawl, chunk_size: int = 1 << 16) -> Iterator[str]:
+    # Read the spool from the start and keep reading while the crawl appends to it.
+    # The incremental decoder keeps a UTF-8 character split between two chunks for the next one.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(crawl.fasta, mode="rb") as spool_fh:
+        while True:
+            finished = crawl.done.is_set()
+            data = spool_fh.read(chunk_size)
+            if data:
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            elif finished:
+                text = decoder.decode(b"", final=True)
+                if text:
+                    yield text
+                return
+            else:
+                crawl.done.wait(0.5)
+
+
+def make_service(registry: CrawlRegistry, host: str = "127.0.0.1", port: int = 8765) -> ThreadingHTTPServer:
+
+    class ServiceHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code: int, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _event(self, **event):
+            self.wfile.write(json.dumps(event).encode() + b"\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == "/status":
+                self._send_json(200, registry.status())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                return self._send_json(404, {"error": "not found"})
+            try:
+                job = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                accessions = [(db, accession) for db, accession in job["accessions"]]
+            except (TypeError, ValueError, KeyError):
+                return self._send_json(400, {"error": 'expected {"accessions": [[db, accession], ...]}'})
+
+            # Start (or join) every crawl of the job now, stream them back in the job's order.
+            # HTTP/1.0 without Content-Length: the end of the stream is the end of the connection.
+            crawls = [registry.acquire(db, accession) for db, accession in accessions]
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                for crawl in crawls:
+                    for text in _follow(crawl):
+                        self._event(accession=crawl.accession, fasta=text)
+                    if crawl.errors.exists() and crawl.errors.stat().st_size:
+                        self._event(accession=crawl.accession, error=crawl.errors.read_text())
+                self._event(done=True, accessions=len(crawls))
+            finally:
+                for crawl in crawls:
+                    registry.release(crawl)
+
+    return ThreadingHTTPServer((host, port), ServiceHandler)
+
+
+def serve(port: int = 8765, host: str = "127.0.0.1", workers: int = 4, **options):
+
+    # The page cache (cache_dir, required by --role serve) is where later jobs find the accessions downloaded
+    # before. It is never evicted, so it isn't put in the temporary spool directory behind the user's back.
+    with tempfile.TemporaryDirectory(prefix="interpro_service_") as spool_dir:
+        registry = CrawlRegistry(spool_dir, workers, **options)
+        server = make_service(registry, host, port)
+        print(f"*~~* Download service listening on http://{host}:{port}/jobs *~~*")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            registry.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def service_client(server: str, accessions_dict: Dict[str, List[str]], output_fasta: str, error_file: str):
+
+    accessions = [(db_key, accession) for db_key, accession_list in accessions_dict.items()
+                                      for accession in accession_list]
+    req = request.Request(server.rstrip("/") + "/jobs",
+                          data=json.dumps({"accessions": accessions}).encode(),
+                          headers={"Content-Type": "application/json"})
+
+    try:
+        res = request.urlopen(req)
+    except URLError as error:
+        raise ServiceError(f"Could not reach the download service at {server}: {error.reason}") from error
+
+    finished = False
+    current = None
+    with res, open(output_fasta, mode="a") as fasta_fh:
+        for line in res:
+            event = json.loads(line)
+            if event.get("done"):
+                finished = True
+            elif "error" in event:
+                with open(error_file, mode="a") as error_fh:
+                    error_fh.write(event["error"])
+            else:
+                if event["accession"] != current:
+                    current = event["accession"]
+                    print(f"$ Receiving accession {current}")
+                fasta_fh.write(event["fasta"])
+
+    if not finished:
+        # The service stopped in the middle of the job
+        with open(error_file, mode="a") as error_fh:
+            error_fh.write(f"Incomplete job: the download service closed the stream during accession {current}\n")
+
+# *--------------------------------------* Sorting the output *--------------------------------------------*
+# The order of the downloaded FASTA depends on the classifier, the API pages and, in parallel or resumed runs,
+# on timing. For stable files the output can be sorted by protein accession, or by (protein accession, entries),
+# with an external merge sort: sorted runs of at most `memory_mb` are written to temporary files and then
+# merged k-way, so multi-gigabyte files never have to fit in memory. Exact duplicate records can be dropped
+# during the merge.
+
+SORT_KEYS = ("accession", "accession-entry")
+# Maximum number of runs merged at once, more runs are merged in several passes
+MAX_MERGE_FAN_IN = 64
+
+
+def iter_fasta_records(fasta_fh) -> Iterator[str]:
+    # Yields each record (header line and sequence lines) as one string ending with a newline
+    record = []
+    for line in fasta_fh:
+        if line.startswith(">") and record:
+            yield "".join(record)
+            record = []
+        # Only the last line of a file may lack its newline; the record must not run into the next one
+        record.append(line if line.endswith("\n") else line + "\n")
+    if record:
+        yield "".join(record)
+
+
+def fasta_sort_key(record: str, key: str = "accession") -> Tuple[str, ...]:
+    # >accession|entries|name or >accession|name
+    end = record.find("\n")
+    fields = record[1:end if end != -1 else len(record)].split(HEADER_SEPARATOR)
+    # The whole record breaks ties, so the order is fully determined and identical records end up together
+    if key == "accession-entry":
+        return (fields[0], fields[1] if len(fields) > 2 else "", record)
+    return (fields[0], record)
+
+
+def _write_run(records: List[str], key: str, tmp_dir: str) -> str:
+    records.sort(key=lambda record: fasta_sort_key(record, key))
+    fd, run = tempfile.mkstemp(prefix=".interpro_sort_", suffix=".fasta", dir=tmp_dir)
+    with os.fdopen(fd, mode="w") as run_fh:
+        run_fh.writelines(records)
+    return run
+
+
+def _merge_runs(runs: List[str], output_fasta: str, key: str, unique: bool = False) -> Tuple[int, int]:
+
+    handles = [open(run, mode="r") for run in runs]
+    written = duplicates = 0
+    previous = None
+    try:
+        with open(output_fasta, mode="w") as fasta_fh:
+            for record in heapq.merge(*(iter_fasta_records(handle) for handle in handles),
+                                      key=lambda record: fasta_sort_key(record, key)):
+                if unique and record == previous:
+                    duplicates += 1
+                    continue
+                fasta_fh.write(record)
+                previous = record
+                written += 1
+    finally:
+        for handle in handles:
+            handle.close()
+
+    return written, duplicates
+
+
+def sort_fasta(input_fasta: str, output_fasta: str, key: str = "accession", memory_mb: float = 256,
+               unique: bool = False, tmp_dir: Optional[str] = None) -> Tuple[int, int]:
+    """Sort a FASTA file by `key` (one of SORT_KEYS) using at most about `memory_mb` of records in memory.
+
+    The output may be the input file. Returns the number of records written and of duplicates dropped.
+    """
+
+    if key not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key {key!r}, expected one of {SORT_KEYS}")
+    if tmp_dir is None:
+        tmp_dir = str(Path(output_fasta).resolve().parent)
+
+    memory = memory_mb * 1024 * 1024
+    runs = []
+    try:
+        # 1. Sorted runs
+        with open(input_fasta, mode="r") as fasta_fh:
+            records, size = [], 0
+            for record in iter_fasta_records(fasta_fh):
+                records.append(record)
+                size += len(record)
+                if size >= memory:
+                    runs.append(_write_run(records, key, tmp_dir))
+                    records, size = [], 0
+            if records or not runs:
+                runs.append(_write_run(records, key, tmp_dir))
+
+        # 2. Merge passes while there are too many runs to open at once
+        duplicates = 0
+        while len(runs) > MAX_MERGE_FAN_IN:
+            merged = []
+            for start in range(0, len(runs), MAX_MERGE_FAN_IN):
+                group = runs[start:start + MAX_MERGE_FAN_IN]
+                fd, run = tempfile.mkstemp(prefix=".interpro_sort_", suffix=".fasta", dir=tmp_dir)
+                os.close(fd)
+                duplicates += _merge_runs(group, run, key, unique)[1]
+                for done in group:
+                    os.remove(done)
+                merged.append(run)
+            runs = merged
+
+        # 3. Final k-way merge, written next to the output and renamed, so the output can be the input
+        fd, sorted_part = tempfile.mkstemp(prefix=".interpro_sort_", suffix=".fasta", dir=tmp_dir)
+        os.close(fd)
+        runs.append(sorted_part)
+        written, dropped = _merge_runs(runs[:-1], sorted_part, key, unique)
+        os.replace(sorted_part, output_fasta)
+        runs.pop()
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+    return written, duplicates + dropped
+
 # *--------------------------------------* Primary logic of the script *------------------------------------*
 def main():
     parser = argparse.ArgumentParser()
     # accession file, output fasta, error file
-    parser.add_argument('--input', '-i', type=str, required=True, help='File with list of accessions.')
-    parser.add_argument('--output', '-o', type=str, required=True, help='The output FASTA file.')
-    parser.add_argument('--error', '-e', type=str, required=True, help='File with accessions that could not be downloaded.')
+    parser.add_argument('--input', '-i', type=str, help='File with list of accessions.')
+    parser.add_argument('--output', '-o', type=str, help='The output FASTA file.')
+    parser.add_argument('--error', '-e', type=str, help='File with accessions that could not be downloaded.')
+    # multi-node mode: a coordinator fills a shared queue, workers drain it, merge builds the final FASTA
+    parser.add_argument('--role', type=str, choices=['coordinator', 'worker', 'merge', 'serve', 'client', 'sort'],
+                        help='Run as queue coordinator, worker or merge step, as download service or its client, '
+                             'or only sort the FASTA given with --input, instead of a single process.')
+    parser.add_argument('--queue', '-q', type=str, help='SQLite work queue file on shared storage.')
+    parser.add_argument('--shard-dir', type=str, help='Directory (on shared storage) for the per-accession shards.')
+    parser.add_argument('--worker-id', type=str, default=f"{socket.gethostname()}-{os.getpid()}",
+                        help='Name of this worker in the queue (default: hostname-pid).')
+    parser.add_argument('--lease-seconds', type=float, default=300,
+                        help='Seconds a claimed accession stays leased without a heartbeat (default: 300).')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to cache API pages in, so re-runs and reclaimed accessions skip finished pages '
+                             '(required for --role serve).')
+    # reproducible performance tests: save the API traffic, or serve a saved one instead of the API
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument('--record', type=str, metavar='ARCHIVE',
+                         help='Save every API request and response (status, headers, timing, body) to this archive.')
+    traffic.add_argument('--replay', type=str, metavar='ARCHIVE',
+                         help='Serve the API responses from an archive saved with --record instead of the API.')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Speed-up of the replayed latencies and waits (default: 1 = original timing, 0 = no waiting).')
+    parser.add_argument('--rate-limit', type=float,
+                        help='Maximum number of API requests per second, shared by all the downloads of the process.')
+    # service mode: one local daemon shared by several users
+    parser.add_argument('--port', type=int, default=8765, help='Port of the download service (default: 8765).')
+    parser.add_argument('--server', type=str, default='http://127.0.0.1:8765',
+                        help='URL of the download service, for --role client (default: http://127.0.0.1:8765).')
+    # planning: probe the size of every accession first and schedule the largest ones first
+    parser.add_argument('--workers', '-w', type=int,
+                        help='Number of accessions downloaded at the same time (default: 1, 4 for --role serve). '
+                             'More than 1 implies --plan.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Probe the number of proteins of every accession, print an estimate and download the largest first.')
+    parser.add_argument('--plan-only', action='store_true',
+                        help='Print the download plan and exit without downloading anything.')
+    # intra-accession parallelism for giant families
+    parser.add_argument('--split-threshold', type=int,
+                        help='Split accessions with more proteins than this into sub-queries crawled concurrently.')
+    parser.add_argument('--split-workers', type=int, default=4,
+                        help='Number of sub-queries of a split accession crawled at the same time (default: 4).')
+    parser.add_argument('--dedupe-hierarchy', action='store_true',
+                        help='Download the signatures of the list integrated in the same InterPro entry of the list '
+                             'together, once per member database. Only signatures from the same member database '
+                             'share a download.')
+    # post-processing: sorted, stable output
+    parser.add_argument('--sort', type=str, choices=SORT_KEYS,
+                        help='Sort the output FASTA by protein accession, or by protein accession and entries.')
+    parser.add_argument('--sort-memory', type=float, default=256,
+                        help='Megabytes of records sorted in memory at a time (default: 256).')
+    parser.add_argument('--unique', action='store_true',
+                        help='Drop exact duplicate records while sorting.')
     args = parser.parse_args()
 
-    # Defining the paths to the files
-    file_path1 = Path(args.output)
-    file_path2 = Path(args.error)
-    # Checking if both files exist
-    if file_path1.exists() or file_path2.exists():
-        print("The output or the error file already exist. Please rename or move the files before proceeding.")
-        # Exit the script gracefully
-        exit()
+    # Arguments each role needs
+    required = {
+        None: ['input'] if args.plan_only else ['input', 'output', 'error'],
+        'coordinator': ['input', 'queue'],
+        'worker': ['queue', 'shard_dir'],
+        'merge': ['queue', 'shard_dir', 'output', 'error'],
+        # every page the service downloads is kept in the page cache, on a disk the user chooses
+        'serve': ['cache_dir'],
+        'client': ['input', 'output', 'error'],
+        'sort': ['input', 'output'],
+    }[args.role]
+    missing = [name for name in required if getattr(args, name) is None]
+    if missing:
+        parser.error("the following arguments are required: " +
+                     ", ".join("--" + name.replace("_", "-") for name in missing))
+
+    if args.dedupe_hierarchy and args.role is not None:
+        parser.error("--dedupe-hierarchy only applies to a single-process download (without --role)")
+
+    if args.role == 'sort':
+        written, duplicates = sort_fasta(args.input, args.output, args.sort or "accession", args.sort_memory, args.unique)
+        print(f"*~~* Sorted {written} records into {args.output} ({duplicates} duplicates dropped) *~~*")
+        return
+
+    def sort_output():
+        # Sort the finished output in place
+        if args.sort and Path(args.output).exists():
+            written, duplicates = sort_fasta(args.output, args.output, args.sort, args.sort_memory, args.unique)
+            print(f"*~~* Sorted {written} records by {args.sort} ({duplicates} duplicates dropped) *~~*")
+
+    if args.workers is None:
+        args.workers = 4 if args.role == 'serve' else 1
+    if args.workers < 1 or args.split_workers < 1:
+        parser.error("--workers and --split-workers must be at least 1")
+    set_rate_limit(args.rate_limit)
+    if args.replay_speed < 0:
+        parser.error("--replay-speed can't be negative")
+    if args.record and Path(args.record).exists():
+        parser.error(f"the traffic archive {args.record} already exists, please use a new file for --record")
+    download_options = dict(cache_dir=args.cache_dir,
+                            split_threshold=args.split_threshold,
+                            split_workers=args.split_workers)
+    args.plan = args.plan or args.plan_only or (args.workers > 1 and args.role is None)
+
+    if args.role in ('merge', 'client') or (args.role is None and not args.plan_only):
+        # Defining the paths to the files
+        file_path1 = Path(args.output)
+        file_path2 = Path(args.error)
+        # Checking if both files exist
+        if file_path1.exists() or file_path2.exists():
+            print("The output or the error file already exist. Please rename or move the files before proceeding.")
+            # Exit the script gracefully
+            exit()
+
+    # Only once every check passed, so a refused run doesn't leave an archive behind
+    set_traffic_archive(args.record, args.replay, args.replay_speed)
+
+    if args.role == 'coordinator':
+        accessions_dict = interpro_accession_classifier(args.input)
+        counts = None
+        if args.plan:
+            # --workers is the number of queue workers you expect to start, only used for the estimate
+            schedule = plan_downloads(accessions_dict, args.workers, cache_dir=args.cache_dir)
+            print_plan(schedule, args.workers)
+            if args.plan_only:
+                return
+            counts = {(item.db, item.accession): item.count for item in schedule}
+        try:
+            n = queue_populate(args.queue, accessions_dict, counts)
+        except QueueError as error:
+            print(error)
+            exit()
+        print(f"*~~* Queued {n} accessions in {args.queue} *~~*")
+        return
+    elif args.role == 'worker':
+        queue_worker(args.queue, args.shard_dir, args.worker_id, args.lease_seconds, **download_options)
+        return
+    elif args.role == 'serve':
+        # --workers is the number of accessions the service downloads at the same time
+        serve(args.port, workers=args.workers, **download_options)
+        return
+
+    if args.plan_only and args.role is None:
+        print_plan(plan_downloads(interpro_accession_classifier(args.input), args.workers, cache_dir=args.cache_dir),
+                   args.workers)
+        return
+
+    if args.role == 'merge':
+        try:
+            queue_merge(args.queue, args.shard_dir, args.output, args.error)
+        except QueueError as error:
+            print(error)
+            exit()
+        sort_output()
+        interpro_credits()
+        return
+    elif args.role == 'client':
+        try:
+            service_client(args.server, interpro_accession_classifier(args.input), args.output, args.error)
+        except ServiceError as error:
+            print(error)
+            exit()
+        print("*~~* Download finished *~~*")
+        sort_output()
+        interpro_credits()
+        return
 
     # Classify accessions by database
     accessions_dict = interpro_accession_classifier(args.input)
 
+    if args.plan:
+        schedule = plan_downloads(accessions_dict, args.workers, cache_dir=args.cache_dir)
+        print_plan(schedule, args.workers)
+
+    if args.plan or args.dedupe_hierarchy:
+        # Shard-based run: accessions start largest first (with --plan), the output keeps the classifier order
+        hierarchy = plan_hierarchy(accessions_dict, cache_dir=args.cache_dir) if args.dedupe_hierarchy else None
+        if not args.plan:
+            schedule = unplanned_schedule(accessions_dict)
+        run_parallel(schedule, args.output, args.error, args.workers, hierarchy=hierarchy, **download_options)
+        print("*~~* Download finished *~~*")
+        sort_output()
+        interpro_credits()
+        return
+
     # Iterating over db_key and list_accessions value in dictionary
     for db_key, accession_list in accessions_dict.items():
         for i, accession in enumerate(accession_list, start = 1):
@@ -252,11 +1715,13 @@ def main():
             interpro_api_sequence_downloader(db=db_key, 
                                             accession=accession, 
                                             output_fasta=args.output, 
-                                            error_file=args.error
+                                            error_file=args.error,
+                                            **download_options
                                             )
             print("\n")
             
     print("*~~* Download finished *~~*")
+    sort_output()
     # Credits to the interpro team for the main code snippet that retrieves data from the API
     interpro_credits()
 
@@ -0,0 +1,72 @@
+import gzip
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import interpro_downloader as downloader
+
+
+def protein_item(accession, *entries, name=None, sequence="MKV" * 10):
+    # One API result; entries are (entry accession, start, end) matches with a single fragment
+    return {"metadata": {"accession": accession, "name": name or f"protein {accession}"},
+            "extra_fields": {"sequence": sequence},
+            "entries": [{"accession": entry,
+                         "entry_protein_locations": [{"fragments": [{"start": start, "end": end}]}]}
+                        for entry, start, end in entries]}
+
+
+def api_page(*results, count=None, next=None):
+    return {"count": len(results) if count is None else count, "next": next, "results": list(results)}
+
+
+def write_archive(archive, exchanges):
+    # A traffic archive as --record writes it; exchanges are (url, status, JSON payload) with no latency
+    with gzip.open(archive, mode="wt") as archive_fh:
+        archive_fh.write(json.dumps({"format": downloader.TRAFFIC_FORMAT, "version": 1}) + "\n")
+        for url, status, payload in exchanges:
+            archive_fh.write(json.dumps({"url": url, "status": status, "headers": {}, "offset": 0, "elapsed": 0,
+                                         "body": json.dumps(payload)}) + "\n")
+
+
+class ApiTestCase(unittest.TestCase):
+    # Each test runs in its own temporary directory (self.dir) against a fake API: self.api maps URLs to a JSON
+    # payload, to the exception the request raises, or to a list of those answered in turn (the last one repeats).
+    # A URL not in it answers 204 (no data). Requests are logged in self.requests and the waits (pauses, retries)
+    # in self.waits, without waiting.
+    fake_api = True
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+        self.api = {}
+        self.requests = []
+        self.waits = []
+
+        patches = [("sleep", self.waits.append)]
+        if self.fake_api:
+            patches.append(("_http_get", self.http_get))
+        for target, value in patches:
+            patcher = mock.patch.object(downloader, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # Counts are cached for the whole run
+        downloader._count_cache.clear()
+        self.addCleanup(downloader._count_cache.clear)
+
+    def http_get(self, url, context):
+        self.requests.append(url)
+        response = self.api.get(url)
+        if isinstance(response, list):
+            response = response.pop(0) if len(response) > 1 else response[0]
+        if response is None:
+            return 204, b""
+        if isinstance(response, BaseException):
+            raise response
+        return 200, json.dumps(response).encode()
@@ -0,0 +1,133 @@
+import contextlib
+import io
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from conftest import ApiTestCase, api_page, protein_item
+import interpro_downloader as downloader
+
+
+def _protein(accession, *entries):
+    # entries are (entry accession, start) matches 21 residues long
+    return protein_item(accession, *((entry, start, start + 20) for entry, start in entries))
+
+
+ACCESSIONS = {"InterPro": ["IPR000001"], "pfam": ["PF00051", "PF00052"], "smart": ["SM00130"]}
+
+API = {
+    f"{downloader.API_URL}/entry/interpro/IPR000001/":
+        {"metadata": {"accession": "IPR000001",
+                      "member_databases": {"pfam": {"PF00051": "Kringle", "PF00052": "Kringle-like"},
+                                           "smart": {"SM00130": "KR"}}}},
+    downloader.protein_url("InterPro", "IPR000001"):
+        api_page(_protein("P1", ("IPR000001", 1)), _protein("P2", ("IPR000001", 5)), _protein("P3", ("IPR000001", 9))),
+    # Shared crawl: each record lists the Pfam signatures integrated in IPR000001 that matched it
+    downloader.protein_url("pfam", downloader.integrated_filter("IPR000001")):
+        api_page(_protein("P1", ("pf00051", 1), ("pf00052", 40)), _protein("P2", ("pf00051", 5))),
+    downloader.count_url("pfam", "PF00051"): api_page(count=2),
+    downloader.count_url("pfam", "PF00052"): api_page(count=1),
+    downloader.protein_url("smart", "SM00130"): api_page(_protein("P3", ("SM00130", 9))),
+}
+
+
+class HierarchyTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api.update(API)
+
+    def run_download(self):
+        output = self.dir / "output.fasta"
+        error = self.dir / "errors.txt"
+        hierarchy = downloader.plan_hierarchy(ACCESSIONS)
+        downloader.run_parallel(downloader.unplanned_schedule(ACCESSIONS), str(output), str(error),
+                                hierarchy=hierarchy)
+        records = output.read_text().split(">")[1:]
+        return hierarchy, [">" + record for record in records], error
+
+    def test_members_are_derived_from_one_shared_crawl(self):
+        hierarchy, records, error = self.run_download()
+
+        self.assertEqual(hierarchy, [downloader.MemberGroup("pfam", "IPR000001", ["PF00051", "PF00052"])])
+        # Neither Pfam signature was crawled on its own
+        self.assertNotIn(downloader.protein_url("pfam", "PF00051"), self.requests)
+        self.assertNotIn(downloader.protein_url("pfam", "PF00052"), self.requests)
+        self.assertEqual([record.split("\n")[0] for record in records], [
+            ">P1|IPR000001(1...21)|protein P1",
+            ">P2|IPR000001(5...25)|protein P2",
+            ">P3|IPR000001(9...29)|protein P3",
+            ">P1|pf00051(1...21)|protein P1",
+            ">P2|pf00051(5...25)|protein P2",
+            ">P1|pf00052(40...60)|protein P1",
+            ">P3|SM00130(9...29)|protein P3",
+        ])
+        self.assertFalse(error.exists())
+
+    def test_member_missing_from_shared_crawl_is_crawled_directly(self):
+        self.api[downloader.count_url("pfam", "PF00052")] = api_page(count=2)
+        self.api[downloader.protein_url("pfam", "PF00052")] = api_page(_protein("P1", ("pf00052", 40)),
+                                                                       _protein("P4", ("pf00052", 2)))
+
+        _, records, _ = self.run_download()
+
+        self.assertNotIn(downloader.protein_url("pfam", "PF00051"), self.requests)
+        self.assertIn(downloader.protein_url("pfam", "PF00052"), self.requests)
+        self.assertIn(">P4|pf00052(2...22)|protein P4", [record.split("\n")[0] for record in records])
+
+    def test_single_member_is_reported(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            downloader.plan_hierarchy(ACCESSIONS)
+
+        self.assertIn("SM00130 is integrated in IPR000001 but is the only smart signature", output.getvalue())
+
+    def test_rejected_with_a_role(self):
+        for role in (["--role", "worker", "--queue", "q", "--shard-dir", "s"],
+                     ["--role", "client", "-i", "in", "-o", "out", "-e", "err"]):
+            with self.subTest(role=role[1]):
+                stderr = io.StringIO()
+                with mock.patch("sys.argv", ["interpro_downloader.py", "--dedupe-hierarchy"] + role), \
+                        contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit):
+                    downloader.main()
+                self.assertIn("--dedupe-hierarchy only applies", stderr.getvalue())
+
+
+class ReplayedHierarchyTest(ApiTestCase):
+    # Replays tests/data/dedupe_hierarchy.jsonl.gz through --replay. The archive is hand-written in the format and
+    # with the response fields of the API (the API couldn't be reached when it was made); record a real one with
+    #   interpro_downloader.py --input tests/data/dedupe_hierarchy.txt --output out.fasta --error errors.txt \
+    #       --dedupe-hierarchy --record tests/data/dedupe_hierarchy.jsonl.gz
+    # The checks hold for any recording in which the shared crawl carried the members' matches.
+    fake_api = False
+    data = Path(__file__).resolve().parent / "data"
+
+    def setUp(self):
+        super().setUp()
+        archive = str(self.data / "dedupe_hierarchy.jsonl.gz")
+        downloader.set_traffic_archive(replay=archive, speed=0)
+        self.addCleanup(downloader.set_traffic_archive)
+        self.recorded = set(downloader.TrafficReplayer(archive).exchanges)
+
+    def test_members_are_derived_from_the_recorded_shared_crawl(self):
+        accessions = downloader.interpro_accession_classifier(str(self.data / "dedupe_hierarchy.txt"))
+        output = self.dir / "output.fasta"
+        error = self.dir / "errors.txt"
+
+        hierarchy = downloader.plan_hierarchy(accessions)
+        downloader.run_parallel(downloader.unplanned_schedule(accessions), str(output), str(error),
+                                hierarchy=hierarchy)
+
+        self.assertTrue(hierarchy)
+        # Every URL was in the archive, and no member of a shared crawl was crawled on its own
+        self.assertFalse(error.exists())
+        headers = [line for line in output.read_text().splitlines() if line.startswith(">")]
+        for group in hierarchy:
+            self.assertIn(downloader.protein_url(group.db, downloader.integrated_filter(group.entry)), self.recorded)
+            for signature in group.signatures:
+                self.assertNotIn(downloader.protein_url(group.db, signature), self.recorded)
+                self.assertTrue(any(f"|{signature.lower()}(" in header.lower() for header in headers), signature)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import asyncio
+import socket
+import unittest
+from urllib.error import HTTPError, URLError
+
+from conftest import ApiTestCase, api_page, protein_item
+import interpro_downloader as downloader
+
+
+PAGE_URL = downloader.protein_url("pfam", "PF00001")
+NEXT_URL = PAGE_URL + "&cursor=2"
+
+PAGES = {
+    PAGE_URL: api_page(protein_item("P1", ("PF00001", 1, 30)), protein_item("P2", ("PF00001", 4, 25)),
+                       count=3, next=NEXT_URL),
+    NEXT_URL: api_page(protein_item("P3", ("PF00001", 2, 28)), count=3),
+}
+
+
+class IteratorTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api.update(PAGES)
+
+    def test_iter_proteins_follows_the_pages(self):
+        proteins = list(downloader.iter_proteins("pfam", "PF00001"))
+
+        self.assertEqual([protein.accession for protein in proteins], ["P1", "P2", "P3"])
+        self.assertEqual(proteins[1].entries, [downloader.EntryLocations("PF00001", [[(4, 25)]])])
+        self.assertEqual(self.requests, [PAGE_URL, NEXT_URL])
+
+    def test_aiter_proteins_matches_iter_proteins(self):
+        async def collect():
+            # asyncio.sleep isn't faked: no pause between the pages
+            return [protein async for protein in downloader.aiter_proteins("pfam", "PF00001", delay=0)]
+
+        self.assertEqual(asyncio.run(collect()), list(downloader.iter_proteins("pfam", "PF00001")))
+
+    def test_cached_pages_are_not_requested_again(self):
+        cache_dir = str(self.dir / "cache")
+        first = list(downloader.iter_proteins("pfam", "PF00001", cache_dir=cache_dir))
+        self.requests.clear()
+
+        self.assertEqual(list(downloader.iter_proteins("pfam", "PF00001", cache_dir=cache_dir)), first)
+        self.assertEqual(self.requests, [])
+
+
+class RetryTest(ApiTestCase):
+
+    def test_network_failures_are_retried(self):
+        for failure in (URLError("net down"), socket.timeout("timed out"), ConnectionResetError()):
+            with self.subTest(failure=failure):
+                self.requests.clear()
+                self.api[PAGE_URL] = [failure, failure, api_page()]
+
+                self.assertEqual(downloader.fetch_page(PAGE_URL), api_page())
+                self.assertEqual(len(self.requests), 3)
+
+    def test_download_error_after_the_retries(self):
+        for failure in (URLError("net down"), HTTPError(PAGE_URL, 500, "Server error", None, None)):
+            with self.subTest(failure=failure):
+                self.requests.clear()
+                self.api[PAGE_URL] = failure
+
+                with self.assertRaises(downloader.DownloadError) as raised:
+                    list(downloader.iter_proteins("pfam", "PF00001", retries=2))
+                self.assertEqual(raised.exception.url, PAGE_URL)
+                self.assertIs(raised.exception.__cause__, failure)
+                self.assertEqual(len(self.requests), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
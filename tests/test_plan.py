@@ -0,0 +1,60 @@
+import unittest
+from urllib.error import HTTPError
+
+from conftest import ApiTestCase, api_page, protein_item
+import interpro_downloader as downloader
+
+
+ACCESSIONS = {"pfam": ["PF00001", "PF00002", "PF00003"], "smart": ["SM00001", "SM00002"]}
+COUNTS = {"PF00001": 10, "PF00002": 900, "PF00003": 450, "SM00001": 900}
+
+
+class PlanTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for db, accessions in ACCESSIONS.items():
+            for accession in accessions:
+                if accession in COUNTS:
+                    self.api[downloader.count_url(db, accession)] = api_page(count=COUNTS[accession])
+                    self.api[downloader.protein_url(db, accession)] = api_page(protein_item(f"P-{accession}",
+                                                                                           (accession, 1, 30)))
+        # SM00002 can't be probed nor downloaded
+        for url in (downloader.count_url("smart", "SM00002"), downloader.protein_url("smart", "SM00002")):
+            self.api[url] = HTTPError(url, 500, "Server error", None, None)
+
+    def test_largest_accessions_first(self):
+        items = downloader.plan_downloads(ACCESSIONS, workers=2)
+
+        # Largest first, equal counts in classifier order, an unknown count last
+        self.assertEqual([(item.position, item.accession, item.count) for item in items],
+                         [(2, "PF00002", 900), (4, "SM00001", 900), (3, "PF00003", 450),
+                          (1, "PF00001", 10), (5, "SM00002", 0)])
+
+    def test_estimated_duration(self):
+        items = downloader.plan_downloads(ACCESSIONS)
+        page = downloader.EST_SECONDS_PER_PAGE
+
+        # 5 + 5 + 3 + 1 + 1 pages on one worker; on two, each accession goes to the first free worker: 5 + 3, 5 + 1 + 1
+        self.assertEqual(downloader.estimated_duration(items, workers=1), 15 * page)
+        self.assertEqual(downloader.estimated_duration(items, workers=2), 8 * page)
+
+    def test_single_worker_downloads_in_plan_order(self):
+        output = self.dir / "output.fasta"
+        error = self.dir / "errors.txt"
+        items = downloader.plan_downloads(ACCESSIONS)
+        self.requests.clear()
+
+        downloader.run_parallel(items, str(output), str(error), workers=1)
+
+        # One worker: the accessions start in plan order (the failing one is retried before giving up)
+        self.assertEqual(list(dict.fromkeys(self.requests)),
+                         [downloader.protein_url(item.db, item.accession) for item in items])
+        # The output keeps the classifier order
+        self.assertEqual([line.split("|")[0] for line in output.read_text().splitlines() if line.startswith(">")],
+                         [">P-PF00001", ">P-PF00002", ">P-PF00003", ">P-SM00001"])
+        self.assertIn("SM00002", error.read_text())
+
+
+if __name__ == "__main__":
+    unittest.main()
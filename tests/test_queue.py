@@ -0,0 +1,133 @@
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from conftest import ApiTestCase, api_page, protein_item
+import interpro_downloader as downloader
+
+
+ACCESSIONS = {"pfam": ["PF00001", "PF00002"], "smart": ["SM00001"]}
+
+
+def _page(accession, *proteins):
+    return api_page(*(protein_item(protein, (accession, 1, 30)) for protein in proteins))
+
+
+class QueueTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api.update({
+            downloader.protein_url("pfam", "PF00001"): _page("PF00001", "P1"),
+            downloader.protein_url("pfam", "PF00002"): _page("PF00002", "P2", "P3"),
+            downloader.protein_url("smart", "SM00001"): _page("SM00001", "P4"),
+        })
+        self.queue = str(self.dir / "queue.sqlite")
+        self.shard_dir = str(self.dir / "shards")
+        self.output = self.dir / "output.fasta"
+        self.error = self.dir / "errors.txt"
+
+    def connect(self):
+        conn = downloader.queue_connect(self.queue)
+        self.addCleanup(conn.close)
+        return conn
+
+    def run_workers(self, *worker_ids):
+        workers = [threading.Thread(target=downloader.queue_worker,
+                                    args=(self.queue, self.shard_dir, worker_id, 60, 0))
+                   for worker_id in worker_ids]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+
+    def expected_fasta(self):
+        return "".join(downloader.format_fasta(downloader.parse_protein(item))
+                       for db, accessions in ACCESSIONS.items() for accession in accessions
+                       for item in self.api[downloader.protein_url(db, accession)]["results"])
+
+    def test_expired_lease_is_reclaimed_by_another_worker(self):
+        downloader.queue_populate(self.queue, ACCESSIONS)
+        conn = self.connect()
+        # A worker claims the first accession and dies: its lease expires without being renewed
+        self.assertEqual(downloader.queue_claim(conn, "dead", lease_seconds=-1), (1, "pfam", "PF00001"))
+
+        self.run_workers("worker-1", "worker-2")
+
+        self.assertEqual(downloader.queue_status(conn), {"done": 3})
+        self.assertEqual(conn.execute("SELECT attempts FROM work WHERE position = 1").fetchone(), (2,))
+        self.assertNotEqual(conn.execute("SELECT worker FROM work WHERE position = 1").fetchone(), ("dead",))
+        downloader.queue_merge(self.queue, self.shard_dir, str(self.output), str(self.error))
+        self.assertEqual(self.output.read_text(), self.expected_fasta())
+        self.assertFalse(self.error.exists())
+
+    def test_live_lease_is_not_claimed_twice(self):
+        downloader.queue_populate(self.queue, ACCESSIONS)
+        conn = self.connect()
+
+        claims = [downloader.queue_claim(conn, f"worker-{n}", lease_seconds=60) for n in range(4)]
+
+        self.assertEqual([claim and claim[0] for claim in claims], [1, 2, 3, None])
+        self.assertTrue(downloader.queue_renew(conn, "worker-0", 1, 60))
+        self.assertFalse(downloader.queue_renew(conn, "worker-1", 1, 60))
+
+    def test_merge_keeps_the_classifier_order(self):
+        # Planned counts: the workers claim the largest accession first
+        downloader.queue_populate(self.queue, ACCESSIONS, counts={("smart", "SM00001"): 10, ("pfam", "PF00002"): 5})
+        conn = self.connect()
+        self.assertEqual(downloader.queue_claim(conn, "probe", 60)[2], "SM00001")
+        conn.execute("UPDATE work SET state = 'pending', attempts = 0")
+
+        with self.assertRaises(downloader.QueueError):
+            downloader.queue_merge(self.queue, self.shard_dir, str(self.output), str(self.error))
+
+        self.run_workers("worker-1")
+        downloader.queue_merge(self.queue, self.shard_dir, str(self.output), str(self.error))
+        self.assertEqual(self.output.read_text(), self.expected_fasta())
+
+    def test_accession_failed_after_max_attempts(self):
+        downloader.queue_populate(self.queue, ACCESSIONS)
+        conn = self.connect()
+        # Every worker that claimed PF00002 died
+        conn.execute("UPDATE work SET state = 'leased', worker = 'dead', lease_expires = 0, attempts = ? "
+                     "WHERE position = 2", (downloader.MAX_ATTEMPTS,))
+
+        self.run_workers("worker-1")
+
+        self.assertEqual(downloader.queue_status(conn), {"done": 2, "failed": 1})
+        downloader.queue_merge(self.queue, self.shard_dir, str(self.output), str(self.error))
+        self.assertNotIn(downloader.protein_url("pfam", "PF00002"), self.requests)
+        self.assertNotIn(">P2|", self.output.read_text())
+        self.assertIn("PF00002 (the worker was lost 3 times)", self.error.read_text())
+
+    def test_unexpected_error_completes_the_accession(self):
+        # A malformed page raises KeyError in the middle of PF00001
+        self.api[downloader.protein_url("pfam", "PF00001")] = api_page({"metadata": {}})
+        downloader.queue_populate(self.queue, ACCESSIONS)
+
+        self.run_workers("worker-1")
+
+        self.assertEqual(downloader.queue_status(self.connect()), {"done": 3})
+        downloader.queue_merge(self.queue, self.shard_dir, str(self.output), str(self.error))
+        self.assertIn("PF00001 (KeyError('accession'))", self.error.read_text())
+        self.assertIn(">P4|", self.output.read_text())
+        self.assertEqual(sorted(path.name for path in (self.dir / "shards").iterdir() if path.suffix == ".part"), [])
+
+
+class RequestTimeoutTest(ApiTestCase):
+    # A connection that hangs times out and is retried, instead of blocking a leased download forever
+    fake_api = False
+
+    def test_hung_request_times_out_and_is_retried(self):
+        url = downloader.protein_url("pfam", "PF00001")
+        with mock.patch.object(downloader.request, "urlopen", side_effect=socket.timeout("timed out")) as urlopen:
+            with self.assertRaises(downloader.DownloadError):
+                downloader.fetch_page(url)
+
+        self.assertEqual(urlopen.call_count, 4)
+        self.assertEqual(urlopen.call_args.kwargs["timeout"], downloader.REQUEST_TIMEOUT)
+
+
+if __name__ == "__main__":
+    unittest.main()
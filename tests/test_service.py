@@ -0,0 +1,89 @@
+import contextlib
+import io
+import threading
+import unittest
+from time import sleep
+from unittest import mock
+
+from conftest import ApiTestCase, api_page, protein_item
+import interpro_downloader as downloader
+
+
+PAGE_URL = downloader.protein_url("pfam", "PF00001")
+NEXT_URL = PAGE_URL + "&cursor=2"
+
+# Long names with multi-byte characters, so the spool is read in several chunks that split characters
+NAME = "protéine " + "é" * 40000
+
+
+def _protein(accession):
+    return protein_item(accession, ("PF00001", 1, 90), name=NAME, sequence="MKV" * 30)
+
+
+PAGES = {
+    PAGE_URL: api_page(_protein("P00001"), _protein("P00002"), count=3, next=NEXT_URL),
+    NEXT_URL: api_page(_protein("P00003"), count=3),
+}
+
+
+class ServiceRoundTripTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api.update(PAGES)
+        self.release = threading.Event()
+
+        spool_dir = self.dir / "spool"
+        spool_dir.mkdir()
+        self.registry = downloader.CrawlRegistry(str(spool_dir), workers=2, cache_dir=str(self.dir / "cache"))
+        self.server = downloader.make_service(self.registry, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def http_get(self, url, context):
+        # The first page waits until both jobs have joined the crawl
+        self.release.wait(10)
+        return super().http_get(url, context)
+
+    def test_overlapping_jobs_share_one_crawl(self):
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        outputs = [self.dir / f"job{n}.fasta" for n in range(2)]
+        errors = [self.dir / f"job{n}.errors.txt" for n in range(2)]
+
+        clients = [threading.Thread(target=downloader.service_client,
+                                    args=(url, {"pfam": ["PF00001"]}, str(output), str(error)))
+                   for output, error in zip(outputs, errors)]
+        for client in clients:
+            client.start()
+
+        # Wait for both jobs to read the same crawl, then let the mocked API answer
+        for _ in range(200):
+            if any(crawl["readers"] == 2 for crawl in self.registry.status()):
+                break
+            sleep(0.05)
+        self.release.set()
+        for client in clients:
+            client.join(30)
+
+        expected = "".join(downloader.format_fasta(downloader.parse_protein(item))
+                           for url in (PAGE_URL, NEXT_URL) for item in PAGES[url]["results"])
+        for output, error in zip(outputs, errors):
+            self.assertEqual(output.read_text(encoding="utf-8"), expected)
+            self.assertFalse(error.exists())
+
+        # One crawl for both jobs: each page was requested once
+        self.assertEqual(sorted(self.requests), sorted(PAGES))
+        self.assertEqual(self.registry.status(), [])
+
+    def test_serve_needs_a_cache_dir(self):
+        # The page cache is never evicted: the service doesn't create one in the temporary directory
+        stderr = io.StringIO()
+        with mock.patch("sys.argv", ["interpro_downloader.py", "--role", "serve"]), \
+                contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit):
+            downloader.main()
+        self.assertIn("--cache-dir", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
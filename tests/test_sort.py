@@ -0,0 +1,37 @@
+import io
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import interpro_downloader as downloader
+
+
+class SortTest(unittest.TestCase):
+
+    def test_last_record_without_newline(self):
+        records = list(downloader.iter_fasta_records(io.StringIO(">B|PF00001(1...4)|b\nAAAA\n>A|PF00002(1...4)|a\nCCCC")))
+
+        self.assertEqual(records, [">B|PF00001(1...4)|b\nAAAA\n", ">A|PF00002(1...4)|a\nCCCC\n"])
+
+    def test_header_without_newline(self):
+        self.assertEqual(downloader.fasta_sort_key(">P1|PF00001(1...4)|name", "accession-entry"),
+                         ("P1", "PF00001(1...4)", ">P1|PF00001(1...4)|name"))
+        self.assertEqual(downloader.fasta_sort_key(">P1"), ("P1", ">P1"))
+
+    def test_runs_without_trailing_newline_are_merged_apart(self):
+        # The input ends without a newline and is sorted in several runs
+        with tempfile.TemporaryDirectory() as tmp:
+            fasta = Path(tmp) / "input.fasta"
+            fasta.write_text(">C|x|c\nGGGG\n>B|x|b\nAAAA\n>A|x|a\nCCCC")
+
+            written, duplicates = downloader.sort_fasta(str(fasta), str(fasta), memory_mb=10 / (1024 * 1024))
+
+            self.assertEqual((written, duplicates), (3, 0))
+            self.assertEqual(fasta.read_text(), ">A|x|a\nCCCC\n>B|x|b\nAAAA\n>C|x|c\nGGGG\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
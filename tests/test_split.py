@@ -0,0 +1,84 @@
+import unittest
+from urllib.error import HTTPError
+
+from conftest import ApiTestCase, api_page, protein_item
+import interpro_downloader as downloader
+
+
+def _proteins(*accessions):
+    return api_page(*(protein_item(accession, ("PF00001", 1, 30)) for accession in accessions))
+
+
+class SplitTest(ApiTestCase):
+    # PF00001 has 5 proteins: 2 reviewed, and 3 unreviewed split between Bacteria (2) and Eukaryota (1)
+
+    def setUp(self):
+        super().setUp()
+        self.counts = {(None, None): 5, ("reviewed", None): 2, ("unreviewed", None): 3,
+                       ("unreviewed", 2): 2, ("unreviewed", 2759): 1}
+        for (source, taxon), count in self.counts.items():
+            self.api[downloader.count_url("pfam", "PF00001", source=source or "UniProt", taxon=taxon)] = api_page(count=count)
+        self.api.update({
+            self.url("reviewed"): _proteins("R1", "R2"),
+            self.url("unreviewed", 2): _proteins("B1", "B2"),
+            self.url("unreviewed", 2759): _proteins("E1"),
+            self.url(): _proteins("R1", "R2", "B1", "B2", "E1"),
+        })
+        self.output = self.dir / "output.fasta"
+        self.error = self.dir / "errors.txt"
+
+    def url(self, source="UniProt", taxon=None):
+        return downloader.protein_url("pfam", "PF00001", source=source, taxon=taxon)
+
+    def download(self, workers=4):
+        return downloader.interpro_api_sequence_downloader("pfam", "PF00001", str(self.output), str(self.error),
+                                                           split_threshold=2, split_workers=workers)
+
+    def headers(self):
+        return [line.split("|")[0] for line in self.output.read_text().splitlines() if line.startswith(">")]
+
+    def test_subqueries_cover_the_accession(self):
+        self.assertEqual(downloader.split_subqueries("pfam", "PF00001", 2),
+                         [(downloader.SubQuery("reviewed"), 2), (downloader.SubQuery("unreviewed", 2), 2),
+                          (downloader.SubQuery("unreviewed", 2759), 1)])
+
+        self.assertEqual(self.download(), 5)
+
+        # The sub-queries are concatenated in order, and the accession isn't crawled in one piece
+        self.assertEqual(self.headers(), [">R1", ">R2", ">B1", ">B2", ">E1"])
+        self.assertNotIn(self.url(), self.requests)
+        self.assertFalse(self.error.exists())
+
+    def test_count_mismatch_is_reported(self):
+        self.api[downloader.count_url("pfam", "PF00001")] = api_page(count=6)
+
+        self.download()
+
+        self.assertEqual(len(self.headers()), 5)
+        self.assertIn("Split download of accession PF00001 has 5 proteins, the API reports 6", self.error.read_text())
+
+    def test_failed_subquery_cancels_the_others(self):
+        self.api[self.url("reviewed")] = HTTPError(self.url("reviewed"), 500, "Server error", None, None)
+
+        self.assertIsNone(self.download(workers=1))
+
+        # Nothing of the accession is written, and the sub-queries after the failed one never start
+        self.assertFalse(self.output.exists())
+        self.assertNotIn(self.url("unreviewed", 2), self.requests)
+        self.assertNotIn(self.url("unreviewed", 2759), self.requests)
+        self.assertIn(f"Last URL: {self.url('reviewed')}", self.error.read_text())
+
+    def test_failed_probe_falls_back_to_an_unsplit_crawl(self):
+        url = downloader.count_url("pfam", "PF00001", source="unreviewed", taxon=2759)
+        self.api[url] = HTTPError(url, 500, "Server error", None, None)
+
+        self.assertEqual(self.download(), 5)
+
+        self.assertEqual(self.headers(), [">R1", ">R2", ">B1", ">B2", ">E1"])
+        self.assertIn(self.url(), self.requests)
+        self.assertNotIn(self.url("reviewed"), self.requests)
+        self.assertFalse(self.error.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
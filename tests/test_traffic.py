@@ -0,0 +1,81 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from conftest import ApiTestCase, api_page, write_archive
+import interpro_downloader as downloader
+
+
+RECORDED_URL = downloader.protein_url("pfam", "PF00001")
+MISSING_URL = downloader.protein_url("pfam", "PF00002")
+
+
+class ReplayTest(ApiTestCase):
+    # The requests go through the real _http_get, answered by the replay archive
+    fake_api = False
+
+    def setUp(self):
+        super().setUp()
+        archive = self.dir / "traffic.jsonl.gz"
+        write_archive(archive, [(RECORDED_URL, 200, api_page())])
+        downloader.set_traffic_archive(replay=str(archive))
+        self.addCleanup(downloader.set_traffic_archive)
+
+    def test_recorded_url_is_replayed(self):
+        self.assertEqual(downloader.fetch_page(RECORDED_URL), api_page())
+
+    def test_missing_url_fails_without_retrying(self):
+        with self.assertRaises(downloader.ReplayMiss) as raised:
+            downloader.fetch_page(MISSING_URL)
+
+        self.assertEqual(raised.exception.url, MISSING_URL)
+        self.assertEqual([wait for wait in self.waits if wait], [])
+
+    def test_missing_url_is_written_to_the_error_file(self):
+        output = self.dir / "output.fasta"
+        error = self.dir / "errors.txt"
+
+        downloader.interpro_api_sequence_downloader("pfam", "PF00002", str(output), str(error))
+
+        self.assertIn(f"{MISSING_URL} is not in the replay archive", error.read_text())
+
+
+class RecordTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(downloader.set_traffic_archive)
+        self.archive = self.dir / "traffic.jsonl.gz"
+        self.input = self.dir / "accessions.txt"
+        self.input.write_text("PF00001\n")
+
+    def main(self, *argv):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch("sys.argv", ["interpro_downloader.py", "-i", str(self.input), "-o", str(self.dir / "out.fasta"),
+                                     "-e", str(self.dir / "errors.txt"), *argv]), \
+                contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit):
+            downloader.main()
+        return stdout.getvalue() + stderr.getvalue()
+
+    def test_existing_archive_is_not_overwritten(self):
+        write_archive(self.archive, [(RECORDED_URL, 200, api_page())])
+        recording = self.archive.read_bytes()
+
+        self.assertIn("already exists", self.main("--record", str(self.archive)))
+
+        self.assertEqual(self.archive.read_bytes(), recording)
+        with self.assertRaises(FileExistsError):
+            downloader.TrafficRecorder(str(self.archive))
+
+    def test_refused_run_does_not_create_an_archive(self):
+        (self.dir / "out.fasta").write_text(">P1|x\nMKV\n")
+
+        self.assertIn("already exist", self.main("--record", str(self.archive)))
+
+        self.assertFalse(self.archive.exists())
+        self.assertEqual(self.requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()